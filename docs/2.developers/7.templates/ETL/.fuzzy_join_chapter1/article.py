@@ -1,6 +1,6 @@
 # ---
-# title: "Automating reconciliation of messy financial transaction logs using Pathway's real-time fuzzy join"
-# description: Article introducing Fuzzy Join.
+# title: "Automating reconciliation of messy financial transaction logs with a real-time fuzzy join in Pathway"
+# description: Article building a real-time fuzzy join with blocking keys in Pathway.
 # notebook_export_path: notebooks/showcases/fuzzy_join_part1.ipynb
 # aside: true
 # article:
@@ -23,7 +23,7 @@
 # ---
 
 # %% [markdown] jp-MarkdownHeadingCollapsed=true
-# # Automating reconciliation of messy financial transaction logs using Pathway's real-time fuzzy join
+# # Automating reconciliation of messy financial transaction logs with a real-time fuzzy join in Pathway
 #
 # ## Fuzzy joins: 'errare humanum est'
 #
@@ -51,8 +51,10 @@
 # Simple use cases include matching lower case strings with camelCase strings or matching
 # floats with some precision threshold.
 #
-# Pathway's standard library comes with a powerful `smart_fuzzy_join` functionality.
-# This tutorial is a showcase of its capabilities. We will develop a Data Application which allows for fuzzy-joining
+# Pathway's standard library comes with a generic `smart_fuzzy_join` functionality, which knows nothing about the data it matches.
+# In this tutorial, we build the fuzzy join ourselves instead, out of Pathway's regular operators, so that it can exploit the structure of the data:
+# an exact join on a blocking key first, then a scoring of the candidate pairs on their fields and, when needed, on their text.
+# We will develop a Data Application which allows for fuzzy-joining
 # two streams of data against each other, and also for maintaining audit entries and updating results on the fly. Here is a sneak preview:
 #
 # ![Demo animation](https://pathway.com/assets/content/showcases/fuzzy_join/demo.gif)
@@ -93,7 +95,7 @@
 #
 #
 # As you can see, it seems that each entry in the first dataset (data sourced automatically) has a corresponding entry in the other dataset (transaction logs entered by hand).
-# In this example we will use the `smart_fuzzy_join` function from Pathway's standard library to make sure all is correctly matched.
+# In this example we will score the pairs of entries with a bounded Levenshtein distance to make sure all is correctly matched.
 #
 # ## What are we going to obtain?
 # We want to obtain a table in which the matchings are expressed, e.g. the entry 0 for the first table corresponds to the entry 1 in the second table.
@@ -103,7 +105,14 @@
 # First things first - imports:
 
 # %%
-import pandas as pd
+import datetime
+import math
+import os
+import re
+import zlib
+from collections.abc import Sequence
+
+import numpy as np
 
 import pathway as pw
 
@@ -157,34 +166,456 @@ pw.debug.compute_and_print(transactionsB)
 
 
 # %% [markdown]
-# Then we use our fuzzy join functions to do the reconciliation between the two tables.
+# The descriptions are compared many times, so we normalize them only once, when they are read.
+# Each description is stored lowercased as bytes, together with its length, the histogram of its bytes,
+# and a 64-bit signature of its 3-grams: each 3-gram sets one bit, chosen by hashing it.
+# The signature is stored as a signed 64-bit integer, as are all integers in Pathway.
+#
+# These features are only used by the fallback scorer, for when [RapidFuzz](https://github.com/rapidfuzz/RapidFuzz) is not installed.
+# When it is installed, they are not computed at all, and the blocks scored later only carry the fields they need.
+
+
+# %%
+# Uncomment to install RapidFuzz.
+# # !pip install rapidfuzz
+try:
+    from rapidfuzz import process
+    from rapidfuzz.distance import Levenshtein
+except ImportError:
+    process = None
+
+
+@pw.udf
+def to_lower_ascii(text: str) -> bytes:
+    return text.encode().lower()
+
+
+@pw.udf
+def length(text: bytes) -> int:
+    return len(text)
+
+
+@pw.udf
+def char_hist(text: bytes) -> np.ndarray:
+    return np.bincount(np.frombuffer(text, dtype=np.uint8), minlength=256).astype(
+        np.int32
+    )
+
+
+QGRAM = 3
+SIGNATURE_MASK = (1 << 64) - 1
+
+
+@pw.udf
+def qgram_sig(text: bytes) -> int:
+    signature = 0
+    for i in range(len(text) - QGRAM + 1):
+        signature |= 1 << (zlib.crc32(text[i : i + QGRAM]) % 64)
+    return signature - (1 << 64) if signature >> 63 else signature
+
+
+if process is not None:
+    TEXT_FEATURES = ["normalized"]
+else:
+    TEXT_FEATURES = ["normalized", "length", "histogram", "signature"]
+
+
+def with_text_features(table: pw.Table, text: pw.ColumnExpression) -> pw.Table:
+    table = table.with_columns(normalized=to_lower_ascii(text))
+    if process is not None:
+        return table
+    return table.with_columns(
+        length=length(pw.this.normalized),
+        histogram=char_hist(pw.this.normalized),
+        signature=qgram_sig(pw.this.normalized),
+    )
+
+
+transactionsB = with_text_features(transactionsB, pw.this.description)
+
+
+# %% [markdown]
+# Then we do the reconciliation between the two tables.
+#
+# Each pair of entries is scored with the normalized [Levenshtein distance](https://en.wikipedia.org/wiki/Levenshtein_distance):
+# the similarity of two strings `a` and `b` is `1 - distance / max(len(a), len(b))`.
+# We are only interested in pairs whose similarity is above a threshold `τ`,
+# so we never need the exact distance once it exceeds `k = floor((1 - τ) * max(len(a), len(b)))`.
+# This lets us use a *bounded* Levenshtein distance: only the cells of the dynamic programming matrix
+# lying at most `k` diagonals away from the main one are filled, and the computation stops as soon as a whole row exceeds `k`.
+# Instead of `len(a) * len(b)` cells, at most `(2k + 1) * min(len(a), len(b))` are computed.
+#
+# The texts are compared byte by byte.
+# If [Numba](https://numba.pydata.org/) is installed, the function is compiled to machine code working directly on the `uint8` buffers of the texts.
+# This function is only a fallback: when RapidFuzz is installed, it is used instead (see below), as its bit-parallel algorithm is much faster.
 
 
 # %%
-def match_transactions(transactionsA, transactionsB):
-    matching = pw.ml.smart_table_ops.fuzzy_match_tables(transactionsA, transactionsB)
-    transactionsA_reconciled = (
-        pw.Table.empty(left=pw.Pointer, right=pw.Pointer, confidence=float)
-        .update_rows(transactionsA.select(left=None, right=None, confidence=0.0))
-        .update_rows(
-            matching.select(
-                pw.this.left, pw.this.right, confidence=pw.this.weight
-            ).with_id(pw.this.left)
+# Uncomment to install Numba.
+# # !pip install numba
+try:
+    import numba
+except ImportError:
+    numba = None
+
+
+def banded_levenshtein(
+    a: Sequence[int],
+    b: Sequence[int],
+    k: int,
+    previous: list[int] | np.ndarray,
+    current: list[int] | np.ndarray,
+) -> int:
+    n, m = len(a), len(b)
+    for i in range(1, n + 1):
+        lo, hi = max(1, i - k), min(m, i + k)
+        # the cell left of the band: the first column, or outside the band
+        current[lo - 1] = i if lo == 1 else k + 1
+        row_min = current[lo - 1]
+        for j in range(lo, hi + 1):
+            value = min(
+                previous[j - 1] + (a[i - 1] != b[j - 1]),
+                previous[j] + 1,
+                current[j - 1] + 1,
+                k + 1,
+            )
+            current[j] = value
+            row_min = min(row_min, value)
+        if row_min > k:
+            return k + 1
+        previous, current = current, previous
+    return previous[m]
+
+
+if numba is not None:
+    banded_levenshtein = numba.njit(nogil=True)(banded_levenshtein)
+
+
+def bounded_levenshtein(a: bytes, b: bytes, k: int) -> int:
+    """Levenshtein distance between a and b, or k + 1 if it is larger than k."""
+    if abs(len(a) - len(b)) > k:
+        return k + 1
+    if len(a) > len(b):
+        a, b = b, a
+    if numba is None:
+        # in pure Python, plain bytes and lists are faster than numpy arrays
+        previous = [min(j, k + 1) for j in range(len(b) + 1)]
+        current = [k + 1] * (len(b) + 1)
+        return banded_levenshtein(a, b, k, previous, current)
+    previous = np.minimum(np.arange(len(b) + 1), k + 1)
+    current = np.full(len(b) + 1, k + 1)
+    return banded_levenshtein(
+        np.frombuffer(a, dtype=np.uint8),
+        np.frombuffer(b, dtype=np.uint8),
+        k,
+        previous,
+        current,
+    )
+
+
+def levenshtein_similarity(a: bytes, b: bytes, threshold: float) -> float:
+    longest = max(len(a), len(b))
+    if longest == 0:
+        return 1.0
+    k = math.floor((1 - threshold) * longest)
+    distance = bounded_levenshtein(a, b, k)
+    if distance > k:
+        return 0.0
+    return 1 - distance / longest
+
+
+# %% [markdown]
+# The histograms give a cheap lower bound on the distance: each edit operation changes the count of at most two bytes,
+# one up and one down, so the distance is at least the total surplus of bytes on either side.
+# When this bound already exceeds `k`, the pair is discarded without filling a single cell of the matrix.
+
+
+# %%
+def histogram_distance(histogram_a: np.ndarray, histogram_b: np.ndarray) -> int:
+    difference = histogram_a - histogram_b
+    return max(difference[difference > 0].sum(), -difference[difference < 0].sum())
+
+
+# %% [markdown]
+# The signatures give another lower bound, even cheaper to compute.
+# An edit operation destroys at most 3 of the 3-grams of a text, so a text within distance `d` of another one
+# has at most `3d` 3-grams missing from the other, hence at most `3d` bits set in its signature which are not set in the other.
+# Counting those bits only takes a few bitwise operations and a population count.
+
+
+# %%
+def signature_distance(signature_a: int, signature_b: int) -> int:
+    only_a = (signature_a & ~signature_b & SIGNATURE_MASK).bit_count()
+    only_b = (signature_b & ~signature_a & SIGNATURE_MASK).bit_count()
+    return math.ceil(max(only_a, only_b) / QGRAM)
+
+
+# %% [markdown]
+# Scoring every entry of `transactionsA` against every entry of `transactionsB` would be quadratic in the size of the datasets.
+# Instead, we first do an exact join on a cheap *blocking key*: the last digits of the recipient account number,
+# which appear verbatim in the descriptions of `transactionsB`.
+# The keys are stored as integers rather than strings: they are hashed and compared as single machine words.
+# Only the pairs sharing a key are then scored, which usually leaves a handful of candidates for each entry.
+#
+# Note that we never search the descriptions for the account numbers of `transactionsA`, which would require one search per entry of `transactionsA`.
+# Each description is scanned once for long runs of digits, and the suffixes found are matched with the account numbers by the join,
+# which looks them up in an index: the cost of finding the candidates does not depend on the size of `transactionsA`.
+# The account numbers of `transactionsA` go through the same extraction, so an account number without such a run of digits
+# gets no key and its entry is simply left unmatched.
+
+
+# %%
+ACCOUNT_NUMBER = re.compile(r"\d{7,}")
+ACCOUNT_SUFFIX_LENGTH = 7
+
+
+@pw.udf
+def account_suffix(account_number: str) -> int | None:
+    numbers = ACCOUNT_NUMBER.findall(account_number)
+    if not numbers:
+        return None
+    return int(numbers[-1][-ACCOUNT_SUFFIX_LENGTH:])
+
+
+@pw.udf
+def account_suffixes(description: str) -> list[int]:
+    suffixes = (
+        int(number[-ACCOUNT_SUFFIX_LENGTH:])
+        for number in ACCOUNT_NUMBER.findall(description)
+    )
+    return list(dict.fromkeys(suffixes))
+
+
+# %% [markdown]
+# Besides the account number, the descriptions contain the amount and the date of the transaction.
+# All three fields are extracted with precompiled regular expressions, once per description, when the descriptions are read.
+# The dates are removed before looking for the amounts, so that years are not mistaken for amounts.
+# Malformed values are not an error: a date or an amount which cannot be parsed, on either side, is simply treated as not matching.
+
+
+# %%
+AMOUNT = re.compile(r"\b\d{3,7}\b")
+DATE = re.compile(r"\d{4}-\d{2}-\d{2}")
+
+
+def parse_date(date: str) -> int | None:
+    try:
+        return datetime.date.fromisoformat(date).toordinal()
+    except ValueError:
+        return None
+
+
+@pw.udf
+def date_ordinal(date: str) -> int | None:
+    return parse_date(date)
+
+
+@pw.udf
+def extract_dates(description: str) -> list[int]:
+    dates = (parse_date(date) for date in DATE.findall(description))
+    return [date for date in dates if date is not None]
+
+
+@pw.udf
+def extract_amounts(description: str) -> list[float]:
+    return [float(amount) for amount in AMOUNT.findall(DATE.sub(" ", description))]
+
+
+transactionsB = transactionsB.with_columns(
+    accounts=account_suffixes(pw.this.description),
+    amounts=extract_amounts(pw.this.description),
+    dates=extract_dates(pw.this.description),
+)
+
+
+# %% [markdown]
+# Calling the scorer pair by pair from Python is slow.
+# If RapidFuzz is installed, we use it instead:
+# its `cdist` function computes the similarities between two whole lists of strings in C++, using a bit-parallel Levenshtein algorithm,
+# and skips the pairs below the threshold early thanks to `score_cutoff`.
+# All the entries sharing a blocking key are gathered and scored at once.
+
+
+# %%
+def pair_similarities(
+    entriesA: Sequence[tuple],
+    entriesB: Sequence[tuple],
+    pairs: Sequence[tuple[int, int]],
+    threshold: float,
+) -> list[float]:
+    if process is not None:
+        rows = sorted({i for i, _ in pairs})
+        columns = sorted({j for _, j in pairs})
+        scores = process.cdist(
+            [entriesA[i][1] for i in rows],
+            [entriesB[j][1] for j in columns],
+            scorer=Levenshtein.normalized_similarity,
+            score_cutoff=threshold,
+            workers=1,
         )
+        row_index = {i: r for r, i in enumerate(rows)}
+        column_index = {j: c for c, j in enumerate(columns)}
+        return [float(scores[row_index[i], column_index[j]]) for i, j in pairs]
+    similarities = []
+    for i, j in pairs:
+        _, a, length_a, histogram_a, signature_a, *_ = entriesA[i]
+        _, b, length_b, histogram_b, signature_b, *_ = entriesB[j]
+        k = math.floor((1 - threshold) * max(length_a, length_b))
+        similarity = 0.0
+        if (
+            abs(length_a - length_b) <= k
+            and signature_distance(signature_a, signature_b) <= k
+            and histogram_distance(histogram_a, histogram_b) <= k
+        ):
+            similarity = levenshtein_similarity(a, b, threshold)
+        similarities.append(similarity)
+    return similarities
+
+
+# %% [markdown]
+# Within a block, the account numbers already match.
+# A pair is then scored on its structured fields first: the amounts should be within 1% and the dates within one day.
+# When both match, the pair gets a full confidence and is not compared as text.
+# Only the ambiguous pairs are compared as text:
+# the fields of `transactionsA` are concatenated and compared with the descriptions of `transactionsB`.
+# As the descriptions contain a lot of text which is not present in `transactionsA`, even the right pairs have a rather low similarity:
+# the threshold is only here to discard the hopeless pairs.
+# The confidence of an ambiguous pair is the average of the account number, amount, date, and text scores.
+#
+# Without RapidFuzz, the Levenshtein distance is computed for the ambiguous pairs only.
+# `cdist` can only score whole rectangles, so with RapidFuzz, all the entries of `transactionsA` and `transactionsB` appearing in some ambiguous pair are scored against each other,
+# which may also score a few pairs already matched on their fields: a single call to `cdist` still costs less than many calls from Python.
+#
+# The blocks are independent, so they are scored in parallel:
+# with the asynchronous executor, the scorer runs in a pool of threads, one block per thread.
+# RapidFuzz and the compiled Levenshtein function release the GIL while they compute, so the threads really run at the same time.
+# Each call to `cdist` then uses a single worker, to avoid starting more threads than there are cores.
+
+
+# %%
+AMOUNT_TOLERANCE = 0.01
+DATE_TOLERANCE = 1
+
+
+@pw.udf(executor=pw.udfs.async_executor(capacity=os.cpu_count()))
+def score_block(
+    entriesA: tuple[tuple, ...],
+    entriesB: tuple[tuple, ...],
+    threshold: float,
+) -> list[tuple[pw.Pointer, pw.Pointer, float]]:
+    matches = []
+    ambiguous = []
+    for i, (left, *_, amount, date) in enumerate(entriesA):
+        for j, (right, *_, amounts, dates) in enumerate(entriesB):
+            amount_matches = amount is not None and any(
+                abs(other - amount) <= AMOUNT_TOLERANCE * amount for other in amounts
+            )
+            date_matches = date is not None and any(
+                abs(other - date) <= DATE_TOLERANCE for other in dates
+            )
+            if amount_matches and date_matches:
+                matches.append((left, right, 1.0))
+            else:
+                ambiguous.append((i, j, 1 + amount_matches + date_matches))
+    if ambiguous:
+        similarities = pair_similarities(
+            entriesA, entriesB, [(i, j) for i, j, _ in ambiguous], threshold
+        )
+        for (i, j, fields), similarity in zip(ambiguous, similarities):
+            if similarity >= threshold:
+                matches.append(
+                    (entriesA[i][0], entriesB[j][0], (fields + similarity) / 4)
+                )
+    best_matches: dict[pw.Pointer, tuple[pw.Pointer, float]] = {}
+    for left, right, weight in matches:
+        if left not in best_matches or weight > best_matches[left][1]:
+            best_matches[left] = (right, weight)
+    return [(left, right, weight) for left, (right, weight) in best_matches.items()]
+
+
+# %% [markdown]
+# For each entry of `transactionsA`, we keep the entry of `transactionsB` with the highest confidence.
+# If no entry of `transactionsB` is similar enough, the entry is left unmatched.
+#
+# As each entry of `transactionsA` has a single blocking key, it belongs to a single block:
+# its best match is selected directly when the block is scored, and no further grouping is needed.
+# The result is obtained with a single left join of `transactionsA` with the best matches.
+#
+# Every step is incremental: when new entries arrive, only the blocks they fall into are scored again.
+
+
+# %%
+def match_transactions(transactionsA, transactionsB, threshold=0.2):
+    keysA = transactionsA.select(
+        key=account_suffix(pw.this.recipient_acc_no),
+        text=pw.this.date
+        + " "
+        + pw.this.amount
+        + " "
+        + pw.this.recipient
+        + " "
+        + pw.this.sender
+        + " "
+        + pw.this.recipient_acc_no
+        + " "
+        + pw.this.sender_acc_no,
+        amount=pw.this.amount.str.parse_float(optional=True),
+        date=date_ordinal(pw.this.date),
+    )
+    keysA = with_text_features(keysA.filter(pw.this.key.is_not_none()), pw.this.text)
+    keysB = transactionsB.with_columns(key=pw.this.accounts).flatten(
+        pw.this.key, origin_id="origin_id"
+    )
+    blocksA = keysA.groupby(pw.this.key).reduce(
+        pw.this.key,
+        entries=pw.reducers.tuple(
+            pw.make_tuple(
+                pw.this.id,
+                *[pw.this[name] for name in TEXT_FEATURES],
+                pw.this.amount,
+                pw.this.date,
+            )
+        ),
+    )
+    blocksB = keysB.groupby(pw.this.key).reduce(
+        pw.this.key,
+        entries=pw.reducers.tuple(
+            pw.make_tuple(
+                pw.this.origin_id,
+                *[pw.this[name] for name in TEXT_FEATURES],
+                pw.this.amounts,
+                pw.this.dates,
+            )
+        ),
+    )
+    matching = (
+        blocksA.join(blocksB, pw.left.key == pw.right.key)
+        .select(pair=score_block(pw.left.entries, pw.right.entries, threshold))
+        .flatten(pw.this.pair)
+        .select(left=pw.this.pair[0], right=pw.this.pair[1], weight=pw.this.pair[2])
+    )
+    transactionsA_reconciled = transactionsA.join_left(
+        matching, pw.left.id == pw.right.left, id=pw.left.id
+    ).select(
+        left=pw.left.id,
+        right=pw.right.right,
+        confidence=pw.coalesce(pw.right.weight, 0.0),
     )
     return transactionsA_reconciled
 
 
 pw.debug.compute_and_print(match_transactions(transactionsA, transactionsB))
 # %% [markdown]
-# Success, all matchings were found!
+# All five entries of `transactionsA` are matched with the right description.
+# Four of them have a full confidence: their account number, amount, and date are all found in the description.
+# The date of M. Perez's transfer is two days off, so this pair is only matched on its text, with a lower confidence.
 #
-# Super easy, few lines of code and you flawlessly manage datasets in different formats.
-# Hassle-free.
+# The pipeline is longer than a single call to a generic fuzzy join,
+# but each step is cheap: an exact join on the blocking keys, a few regular expressions, and text comparisons restricted to the ambiguous pairs.
 #
 # ## Scaling with Pathway
 #
-# `smart_fuzzy_join` is able to handle much bigger datasets.
+# The matching is able to handle much bigger datasets.
 # Feel free to test it on your own data or use the full datasets from this tutorial,
 # available [in this Google Spreadsheet](https://docs.google.com/spreadsheets/d/1cXAPcmkq0t0ieIQCBrdKPG2Fq_DimAzzxfHsDWrtdW0/edit?usp=sharing).
 #
@@ -209,4 +640,4 @@ pw.debug.compute_and_print(match_transactions(transactionsA, transactionsB))
 #
 # **Challenge 2**
 #
-# Try to augment the datasets so that they are still reasonable but `smart_fuzzy_join` fails to find all matchings 😉
+# Try to augment the datasets so that they are still reasonable but the matching fails to find all matchings 😉
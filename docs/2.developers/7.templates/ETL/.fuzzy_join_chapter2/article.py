@@ -31,7 +31,7 @@
 #
 # In this article, we are going to show you how Pathway interacts with incremental data flows with a **feedback loop**.
 #
-# In the [another showcase](/developers/templates/etl/fuzzy_join_chapter1) we explained how `smart_fuzzy_join` may be helpful in bookkeeping.
+# In the [another showcase](/developers/templates/etl/fuzzy_join_chapter1) we explained how a fuzzy join may be helpful in bookkeeping.
 # Previously, we had a simple pipeline that matched entries of two different tables, such as two logs of bank transfers, in two different formats.
 # Many matchings can be inferred automatically, but some can be really tricky without help: while the fans of Harry Potter can instantaneously make the connection between 'You-Know-Who' and 'Voldemort', it is impossible for a computer to do so, at least without help.
 #
@@ -79,7 +79,8 @@
 #
 # ## Automatic reconciliation
 # Let's see how many records we can match without any human help.
-# We reuse code from [Part 1 of this showcase](/developers/templates/etl/fuzzy_join_chapter1).
+# The pipeline of [Part 1 of this showcase](/developers/templates/etl/fuzzy_join_chapter1) relies on account numbers, amounts, and dates, none of which appear here.
+# Instead, we use the generic fuzzy join of Pathway's standard library, `fuzzy_match_tables`, which also accepts the matchings suggested by an auditor.
 # %%
 import pandas as pd
 
@@ -136,7 +137,7 @@ def match_transactions(transactionsA, transactionsB, by_hand_matching):
     )
 
     transactionsA_reconciled = transactionsA.select(
-        left=None, right=None, confidence=0.0
+        left=pw.this.id, right=pw.declare_type(pw.Pointer | None, None), confidence=0.0
     ).update_rows(
         matching.select(pw.this.left, pw.this.right, confidence=pw.this.weight).with_id(
             pw.this.left